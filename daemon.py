@@ -0,0 +1,203 @@
+"""
+Long-running mode for `tracker.py --daemon`.
+
+Each selected source is refreshed on its own cadence instead of all of them once a
+week. The process keeps the enrichment caches, the HTTP session and the Sheets
+client warm between runs, and after every cycle that refreshed something the
+latest output of all sources is written to the sink. A small HTTP server on
+127.0.0.1 exposes /health (JSON) and /metrics (Prometheus text format).
+"""
+
+import json
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sources import http_client
+
+# Seconds between refreshes; CT.gov and CTIS change daily, the EMA under-evaluation list monthly
+DEFAULT_CADENCES = {
+    "ctgov": 86400,
+    "ctis": 86400,
+    "fda": 86400,
+    "ema_approvals": 7 * 86400,
+    "ema_under_eval": 30 * 86400,
+}
+RETRY_AFTER_ERROR = 900          # a failed stage is retried sooner than its cadence
+CACHE_RELOAD_SECONDS = 86400     # reloading re-applies cache TTLs and compaction
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        radar = self.server.radar
+        if self.path == "/health":
+            body = json.dumps(radar.health(), indent=2).encode("utf-8")
+            content_type = "application/json"
+        elif self.path == "/metrics":
+            body = radar.metrics().encode("utf-8")
+            content_type = "text/plain; version=0.0.4"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep probes out of the run log
+        pass
+
+
+class Daemon:
+    def __init__(self, args, ctx, pipeline):
+        """
+        pipeline is the tracker module (run_stage, write_events, SOURCES); args.schedule
+        holds the cadences in seconds, already validated by its parse_args.
+        """
+        self.args = args
+        self.ctx = ctx
+        self.pipeline = pipeline
+        self.cadences = args.schedule
+        self.stages = [name for name in pipeline.SOURCES if name in args.sources]
+        if not self.stages:
+            raise ValueError("Daemon needs at least one source")
+
+        self.results = ctx["results"] = {}
+        ctx["warm_caches"] = {}
+        self.status = {
+            name: {"runs": 0, "errors": 0, "overruns": 0, "events": 0, "last_run": None, "last_success": None,
+                   "duration": None, "last_error": "", "next_run": 0.0}
+            for name in self.stages
+        }
+        self.sink_writes = 0
+        self.sink_errors = 0
+        self.last_sink_error = ""
+        self.started = time.time()
+        self._caches_loaded_at = time.time()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def health(self):
+        with self._lock:
+            stages = {name: dict(st) for name, st in self.status.items()}
+        failing = [name for name, st in stages.items() if st["last_error"]]
+        return {
+            "status": "degraded" if failing or self.last_sink_error else "ok",
+            "uptime_seconds": round(time.time() - self.started),
+            "failing_stages": failing,
+            "last_sink_error": self.last_sink_error,
+            "stages": stages,
+            "http": http_client.limits(),
+        }
+
+    def metrics(self):
+        lines = []
+        with self._lock:
+            for name, st in self.status.items():
+                label = f'{{stage="{name}"}}'
+                lines += [
+                    f"pipeline_radar_stage_runs_total{label} {st['runs']}",
+                    f"pipeline_radar_stage_errors_total{label} {st['errors']}",
+                    f"pipeline_radar_stage_overruns_total{label} {st['overruns']}",
+                    f"pipeline_radar_stage_events{label} {st['events']}",
+                    f"pipeline_radar_stage_duration_seconds{label} {st['duration'] or 0:.3f}",
+                    f"pipeline_radar_stage_last_success_timestamp_seconds{label} {st['last_success'] or 0:.0f}",
+                ]
+            lines += [
+                f"pipeline_radar_sink_writes_total {self.sink_writes}",
+                f"pipeline_radar_sink_errors_total {self.sink_errors}",
+            ]
+        for host, ctl in http_client.limits().items():
+            label = f'{{host="{host}"}}'
+            lines += [
+                f"pipeline_radar_http_rate{label} {ctl['rate']:.3f}",
+                f"pipeline_radar_http_concurrency{label} {ctl['concurrency']}",
+                f"pipeline_radar_http_requests_total{label} {ctl['requests']}",
+                f"pipeline_radar_http_throttled_total{label} {ctl['throttled']}",
+            ]
+        return "\n".join(lines) + "\n"
+
+    def run_cycle(self, due):
+        if time.time() - self._caches_loaded_at > CACHE_RELOAD_SECONDS:
+            self.ctx["warm_caches"].clear()
+            self._caches_loaded_at = time.time()
+
+        refreshed = False
+        for name in due:
+            st = self.status[name]
+            t0 = time.time()
+            overruns = len(self.ctx["overruns"])
+            try:
+                events = self.pipeline.run_stage(self.args, self.ctx, name)
+            except Exception as ex:
+                print(f"Warning: stage {name} failed, keeping its previous output: {ex!r}")
+                with self._lock:
+                    st["runs"] += 1
+                    st["errors"] += 1
+                    st["last_run"] = t0
+                    st["duration"] = time.time() - t0
+                    st["last_error"] = repr(ex)
+                    st["next_run"] = t0 + min(self.cadences[name], RETRY_AFTER_ERROR)
+                continue
+
+            overran = len(self.ctx["overruns"]) > overruns
+            with self._lock:
+                self.results[name] = events
+                st["runs"] += 1
+                st["events"] = len(events)
+                st["last_run"] = t0
+                st["duration"] = time.time() - t0
+                if overran:
+                    # Output is the previous rows marked stale; try again sooner
+                    st["overruns"] += 1
+                    st["last_error"] = "deadline exceeded"
+                    st["next_run"] = t0 + min(self.cadences[name], RETRY_AFTER_ERROR)
+                else:
+                    st["last_success"] = t0
+                    st["last_error"] = ""
+                    st["next_run"] = t0 + self.cadences[name]
+            refreshed = True
+
+        if not refreshed:
+            return
+        try:
+            self.pipeline.write_events(self.args, self.ctx, self.results)
+            # Without a sink the overruns were only logged
+            self.ctx["overruns"].clear()
+            self.sink_writes += 1
+            self.last_sink_error = ""
+        except Exception as ex:
+            self.sink_errors += 1
+            self.last_sink_error = repr(ex)
+            print(f"Warning: writing events failed: {ex!r}")
+
+    def _start_server(self):
+        server = ThreadingHTTPServer(("127.0.0.1", self.args.port), _Handler)
+        server.daemon_threads = True
+        server.radar = self
+        threading.Thread(target=server.serve_forever, name="daemon-http", daemon=True).start()
+        print(f"Health and metrics on http://127.0.0.1:{self.args.port}/health, /metrics")
+        return server
+
+    def serve_forever(self):
+        signal.signal(signal.SIGTERM, lambda *_: self._stop.set())
+        server = self._start_server() if self.args.port else None
+        schedule = ", ".join(f"{name}={self.cadences[name] / 3600:g}h" for name in self.stages)
+        print(f"Daemon started: {schedule}")
+
+        try:
+            while not self._stop.is_set():
+                now = time.time()
+                due = [name for name in self.stages if self.status[name]["next_run"] <= now]
+                if due:
+                    self.run_cycle(due)
+                next_run = min(st["next_run"] for st in self.status.values())
+                self._stop.wait(max(next_run - time.time(), 1.0))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if server is not None:
+                server.shutdown()
+        print("Daemon stopped")
@@ -0,0 +1,148 @@
+"""
+Per-stage profiling for `tracker.py --profile`.
+
+Each stage is run under cProfile (CPU time of the stage's own thread), a wall-clock
+stack sampler and tracemalloc. The sampler covers the stage's thread and the pool
+threads working for it (those running tasks in a copy of the stage's context, as
+the sources do), so network waits show up but unrelated threads such as the caller
+blocked in join() or the daemon's HTTP server don't.
+
+For every stage this writes, into the output directory:
+
+    <stage>.txt        wall/CPU time, peak memory, top allocation sites and the
+                       cProfile hotspots sorted by own and cumulative time
+    <stage>.collapsed  sampled stacks in collapsed format ("a;b;c count") for
+                       flamegraph.pl, speedscope or inferno
+    <stage>.prof       raw cProfile data for pstats/snakeviz
+"""
+
+import contextvars
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+SAMPLE_INTERVAL = 0.005   # seconds between stack samples
+TOP_FUNCTIONS = 25
+TOP_ALLOCATIONS = 10
+
+
+# Idents of the threads working for the stage being profiled
+_stage_threads = contextvars.ContextVar("profiler_stage_threads", default=None)
+
+
+def _join_stage(frame, event, arg):
+    # Profile hook of threads started during a stage: a thread joins the stage on its first
+    # call made in the stage's context (e.g. a pool task run with copy_context().run)
+    threads = _stage_threads.get()
+    if threads is not None:
+        threads.add(threading.get_ident())
+        sys.setprofile(None)
+
+
+class _StackSampler(threading.Thread):
+    def __init__(self, threads, interval=SAMPLE_INTERVAL):
+        super().__init__(name="profiler-sampler", daemon=True)
+        self.threads = threads
+        self.interval = interval
+        self.stacks = Counter()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            threads = set(self.threads)
+            for ident, frame in sys._current_frames().items():
+                if ident not in threads:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def _allocation_lines(snapshot):
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ))
+    lines = []
+    for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+        frame = stat.traceback[0]
+        lines.append(f"  {stat.size / 1024 / 1024:8.2f} MiB  {stat.count:8d} blocks  {frame.filename}:{frame.lineno}")
+    return lines
+
+
+def _hotspot_lines(profile, sort_key):
+    out = io.StringIO()
+    pstats.Stats(profile, stream=out).strip_dirs().sort_stats(sort_key).print_stats(TOP_FUNCTIONS)
+    return out.getvalue().rstrip().splitlines()
+
+
+@contextmanager
+def profile_stage(name, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    profile = cProfile.Profile()
+    threads = {threading.get_ident()}
+    token = _stage_threads.set(threads)
+    sampler = _StackSampler(threads)
+
+    tracemalloc.start()
+    wall0 = time.perf_counter()
+    cpu0 = time.process_time()
+    sampler.start()
+    # Only threads started from here on get the hook, not the sampler itself
+    threading.setprofile(_join_stage)
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        sampler.stop()
+        threading.setprofile(None)
+        _stage_threads.reset(token)
+        wall = time.perf_counter() - wall0
+        cpu = time.process_time() - cpu0
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        base = os.path.join(out_dir, name)
+        profile.dump_stats(f"{base}.prof")
+        with open(f"{base}.collapsed", "w") as f:
+            for stack, count in sampler.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        lines = [
+            f"Stage: {name}",
+            f"Wall time: {wall:.2f}s",
+            f"CPU time (process): {cpu:.2f}s",
+            f"Peak traced memory: {peak / 1024 / 1024:.2f} MiB",
+            "",
+            f"Top {TOP_ALLOCATIONS} allocation sites at stage end:",
+            *_allocation_lines(snapshot),
+            "",
+            "Hotspots by own time (stage thread only):",
+            *_hotspot_lines(profile, "tottime"),
+            "",
+            "Hotspots by cumulative time (stage thread only):",
+            *_hotspot_lines(profile, "cumulative"),
+        ]
+        with open(f"{base}.txt", "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+        print(f"Profile {name}: wall {wall:.2f}s, CPU {cpu:.2f}s, peak {peak / 1024 / 1024:.1f} MiB -> {base}.txt")
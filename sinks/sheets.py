@@ -1,5 +1,11 @@
+import contextvars
+import hashlib
 import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, timedelta
 import gspread
 from google.oauth2.service_account import Credentials
 
@@ -11,33 +17,154 @@ SCOPES = [
 COLUMNS = [
     "event_id", "date_detected", "source", "signal_type", "asset_name", "aliases", "company",
     "indication_raw", "id", "start_date", "last_update",
-    "geography", "source_url", "title", "summary"
+    "geography", "source_url", "title", "summary", "stale"
 ]
+# Sheets written before the "stale" column existed don't have it
+_REQUIRED_EVENT_COLUMNS = [c for c in COLUMNS if c != "stale"]
 
-CACHE_COLUMNS = ["ct_number", "asset_name", "start_date"]
-COMPANY_MAP_COLUMNS = ["inn", "ema_no", "company", "source", "nct_id"]
+# New cache columns are only ever appended, so rows written under an older header stay aligned
+# products: compact JSON snapshot of the trial's products, see sources.ctis._snapshot
+CACHE_COLUMNS = ["ct_number", "asset_name", "start_date", "fetched_at", "products"]
+COMPANY_MAP_COLUMNS = ["inn", "ema_no", "company", "source", "nct_id", "fetched_at"]
+OVERRUN_COLUMNS = ["stage", "deadline_seconds", "elapsed_seconds", "started_at", "abandoned", "stale_rows"]
+
+# Positive entries are refreshed after CACHE_TTL_DAYS, empty (negative) entries are retried
+# after CACHE_NEGATIVE_TTL_DAYS. At most CACHE_REFRESH_LIMIT expired positive entries are
+# refreshed per run so a backlog of old entries is worked off over several runs.
+CACHE_TTL_DAYS = float(os.environ.get("CACHE_TTL_DAYS", "90"))
+CACHE_NEGATIVE_TTL_DAYS = float(os.environ.get("CACHE_NEGATIVE_TTL_DAYS", "7"))
+CACHE_REFRESH_LIMIT = int(os.environ.get("CACHE_REFRESH_LIMIT", "100"))
+# Caches are append-only; rewrite the worksheet once duplicates exceed this share of the rows
+CACHE_COMPACT_RATIO = 1.25
+
+# Partitioned event writes: one worksheet per source or signal_type, written concurrently
+# in chunks of SHEETS_CHUNK_ROWS rows, listed in a "<worksheet>_index" tab
+PARTITION_KEYS = ("source", "signal_type")
+INDEX_COLUMNS = ["partition", "worksheet", "rows", "refreshed_at"]
+SHEETS_MAX_WORKERS = int(os.environ.get("SHEETS_MAX_WORKERS", "4"))
+SHEETS_CHUNK_ROWS = int(os.environ.get("SHEETS_CHUNK_ROWS", "5000"))
+
+_gc = None
+_gc_lock = threading.Lock()
 
 def _client():
-    creds = Credentials.from_service_account_info(
-        json.loads(os.environ["GOOGLE_SERVICE_ACCOUNT_JSON"]),
-        scopes=SCOPES
-    )
-    return gspread.authorize(creds)
+    # One authorized client per process: its session and token are reused across calls,
+    # checkpoints, partition writer threads and daemon cycles
+    global _gc
+    with _gc_lock:
+        if _gc is None:
+            creds = Credentials.from_service_account_info(
+                json.loads(os.environ["GOOGLE_SERVICE_ACCOUNT_JSON"]),
+                scopes=SCOPES
+            )
+            _gc = gspread.authorize(creds)
+        return _gc
+
+def _ensure_headers(ws, headers):
+    if ws.row_values(1) == headers:
+        return
+    if ws.col_count < len(headers):
+        ws.add_cols(len(headers) - ws.col_count)
+    ws.update("A1", [headers])
 
 def get_or_create_worksheet(spreadsheet, name, headers):
     try:
         ws = spreadsheet.worksheet(name)
+        _ensure_headers(ws, headers)
     except gspread.exceptions.WorksheetNotFound:
         ws = spreadsheet.add_worksheet(title=name, rows=2000, cols=len(headers))
         ws.update("A1", [headers])
     return ws
 
+def _now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+def _parse_ts(value):
+    try:
+        ts = datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+    return ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+
+def _jitter(key):
+    """Stable per-key value in [0, 1) used to spread expiries across runs."""
+    return int(hashlib.sha256(key.encode("utf-8")).hexdigest()[:8], 16) / 0x100000000
+
+def _is_expired(key, row, negative, now):
+    fetched_at = _parse_ts(row.get("fetched_at", ""))
+    if fetched_at is None:
+        return True
+    ttl = CACHE_NEGATIVE_TTL_DAYS if negative else CACHE_TTL_DAYS
+    # Expire somewhere in the last quarter of the TTL so entries cached together don't all
+    # come due on the same run
+    ttl *= 1 - 0.25 * _jitter(key)
+    return now - fetched_at > timedelta(days=ttl)
+
+def _compact_cache(ws, headers, rows, latest, label):
+    # Overwrite in place, then drop the leftover tail. The sheet is never empty in between,
+    # and if the resize fails the leftover rows are the original tail, so the last row per
+    # key is still the latest one. A failed compaction only means it's retried next run.
+    try:
+        _with_retry(lambda: ws.update("A1", [headers] + [[r.get(c, "") for c in headers] for r in latest.values()]))
+        _with_retry(lambda: ws.resize(rows=len(latest) + 1))
+    except Exception as ex:
+        print(f"Warning: {label} compaction failed, keeping {len(rows)} rows: {ex!r}")
+        return
+    print(f"{label} compacted: {len(rows)} -> {len(latest)} rows")
+
+def _load_cache(ws, headers, key_fn, is_negative, label):
+    """
+    Returns {key: row} keeping the latest row per key. Expired entries are kept but
+    flagged with "stale": True so callers refetch them and can fall back to the old
+    value if the refresh fails.
+    """
+    rows = ws.get_all_records(expected_headers=headers)
+    latest = {}
+    for r in rows:
+        key = key_fn(r)
+        if key:
+            latest[key] = r
+
+    if len(rows) > len(latest) * CACHE_COMPACT_RATIO:
+        _compact_cache(ws, headers, rows, latest, label)
+
+    now = datetime.now(timezone.utc)
+    expired_positive = 0
+    expired_negative = 0
+    for key, r in latest.items():
+        negative = is_negative(r)
+        if not _is_expired(key, r, negative, now):
+            continue
+        if negative:
+            expired_negative += 1
+        elif expired_positive < CACHE_REFRESH_LIMIT:
+            expired_positive += 1
+        else:
+            continue
+        r["stale"] = True
+
+    print(f"{label}: {expired_positive} entries due for refresh, {expired_negative} empty entries to retry")
+    return latest
+
 def load_ctis_cache(spreadsheet_id):
     gc = _client()
     ss = gc.open_by_key(spreadsheet_id)
     ws = get_or_create_worksheet(ss, "ctis_cache", CACHE_COLUMNS)
-    rows = ws.get_all_records(expected_headers=CACHE_COLUMNS)
-    return {r["ct_number"]: {"asset_name": r["asset_name"], "start_date": r["start_date"]} for r in rows if r.get("ct_number")}
+    rows = _load_cache(
+        ws, CACHE_COLUMNS,
+        key_fn=lambda r: str(r.get("ct_number", "")).strip(),
+        is_negative=lambda r: not str(r.get("asset_name", "")).strip(),
+        label="CTIS cache",
+    )
+    cache = {}
+    for ct, r in rows.items():
+        cache[ct] = {
+            "asset_name": r["asset_name"], "start_date": r["start_date"],
+            "fetched_at": r["fetched_at"], "products": r["products"],
+        }
+        if r.get("stale"):
+            cache[ct]["stale"] = True
+    return cache
 
 def save_ctis_cache(spreadsheet_id, cache_updates):
     if not cache_updates:
@@ -45,16 +172,24 @@ def save_ctis_cache(spreadsheet_id, cache_updates):
     gc = _client()
     ss = gc.open_by_key(spreadsheet_id)
     ws = get_or_create_worksheet(ss, "ctis_cache", CACHE_COLUMNS)
-    rows = [[ct, v["asset_name"], v["start_date"]] for ct, v in cache_updates.items()]
-    ws.append_rows(rows, value_input_option="RAW")
+    fetched_at = _now_iso()
+    rows = [
+        [ct, v["asset_name"], v["start_date"], v.get("fetched_at") or fetched_at, v.get("products", "")]
+        for ct, v in cache_updates.items()
+    ]
+    _with_retry(lambda: ws.append_rows(rows, value_input_option="RAW"))
     print(f"CTIS cache updated: {len(rows)} new entries")
 
 def load_ema_company_map(spreadsheet_id):
     gc = _client()
     ss = gc.open_by_key(spreadsheet_id)
     ws = get_or_create_worksheet(ss, "ema_company_map", COMPANY_MAP_COLUMNS)
-    rows = ws.get_all_records(expected_headers=COMPANY_MAP_COLUMNS)
-    return {r["inn"].lower(): r for r in rows if r.get("inn")}
+    return _load_cache(
+        ws, COMPANY_MAP_COLUMNS,
+        key_fn=lambda r: str(r.get("inn", "")).strip().lower(),
+        is_negative=lambda r: not str(r.get("company", "")).strip(),
+        label="EMA company map",
+    )
 
 def save_ema_company_map(spreadsheet_id, new_entries):
     if not new_entries:
@@ -62,14 +197,142 @@ def save_ema_company_map(spreadsheet_id, new_entries):
     gc = _client()
     ss = gc.open_by_key(spreadsheet_id)
     ws = get_or_create_worksheet(ss, "ema_company_map", COMPANY_MAP_COLUMNS)
-    rows = [[e["inn"], e["ema_no"], e["company"], e["source"], e["nct_id"]] for e in new_entries]
-    ws.append_rows(rows, value_input_option="RAW")
+    fetched_at = _now_iso()
+    rows = [
+        [e["inn"], e["ema_no"], e["company"], e["source"], e["nct_id"], e.get("fetched_at") or fetched_at]
+        for e in new_entries
+    ]
+    _with_retry(lambda: ws.append_rows(rows, value_input_option="RAW"))
     print(f"EMA company map updated: {len(rows)} new entries")
 
-def upsert_events(spreadsheet_id, worksheet_name, events):
+def record_overruns(spreadsheet_id, overruns):
+    if not overruns:
+        return
+    gc = _client()
+    ss = gc.open_by_key(spreadsheet_id)
+    ws = get_or_create_worksheet(ss, "stage_overruns", OVERRUN_COLUMNS)
+    rows = [[o[col] for col in OVERRUN_COLUMNS] for o in overruns]
+    ws.append_rows(rows, value_input_option="RAW")
+    print(f"Stage overruns recorded: {len(rows)}")
+
+def _with_retry(fn, retries=5, backoff=10.0):
+    """Retries fn() when the Sheets API answers 429 (per-minute write quota exceeded)."""
+    for attempt in range(retries):
+        try:
+            return fn()
+        except gspread.exceptions.APIError as ex:
+            if ex.response.status_code != 429 or attempt == retries - 1:
+                raise
+            wait = backoff * 2 ** attempt
+            print(f"Sheets quota exceeded, waiting {wait:.0f}s before retry {attempt + 1}/{retries - 1}...")
+            time.sleep(wait)
+
+def _index_title(worksheet_name):
+    return f"{worksheet_name}_index"
+
+def _partition_titles(ss, worksheet_name):
+    """Worksheets listed in the partition index, or None if there is no index yet."""
+    try:
+        ws = ss.worksheet(_index_title(worksheet_name))
+    except gspread.exceptions.WorksheetNotFound:
+        return None
+    return [r["worksheet"] for r in ws.get_all_records(expected_headers=INDEX_COLUMNS) if r.get("worksheet")]
+
+def load_events(spreadsheet_id, worksheet_name, partition_by=None):
+    gc = _client()
+    ss = gc.open_by_key(spreadsheet_id)
+    titles = _partition_titles(ss, worksheet_name) if partition_by else None
+    if titles is None:
+        # Not partitioned yet: the first partitioned run carries rows over from the single worksheet
+        titles = [worksheet_name]
+    events = []
+    for title in titles:
+        try:
+            ws = ss.worksheet(title)
+        except gspread.exceptions.WorksheetNotFound:
+            if partition_by:
+                continue
+            raise
+        rows = ws.get_all_records(expected_headers=_REQUIRED_EVENT_COLUMNS, numericise_ignore=["all"])
+        if partition_by:
+            rows = _drop_leftovers(rows)
+        events += rows
+    return events
+
+def _drop_leftovers(rows):
+    # A partition whose write was interrupted holds the new rows followed by older ones
+    seen = set()
+    kept = []
+    for r in rows:
+        if r.get("event_id") and r["event_id"] in seen:
+            continue
+        seen.add(r.get("event_id"))
+        kept.append(r)
+    return kept
+
+def _write_partition(ss, title, events):
+    ws = _with_retry(lambda: get_or_create_worksheet(ss, title, COLUMNS))
+    rows = [COLUMNS] + [[e.get(col, "") for col in COLUMNS] for e in events]
+    if ws.row_count < len(rows):
+        _with_retry(lambda: ws.add_rows(len(rows) - ws.row_count))
+    # Overwrite, then trim: a failed chunk leaves older rows behind instead of an empty
+    # or truncated partition
+    for start in range(0, len(rows), SHEETS_CHUNK_ROWS):
+        chunk = rows[start:start + SHEETS_CHUNK_ROWS]
+        _with_retry(lambda: ws.update(f"A{start + 1}", chunk))
+    _with_retry(lambda: ws.resize(rows=len(rows)))
+    return len(events)
+
+def _upsert_partitioned(spreadsheet_id, worksheet_name, events, partition_by):
+    if partition_by not in PARTITION_KEYS:
+        raise ValueError(f"partition_by must be one of {PARTITION_KEYS}, got {partition_by!r}")
+
+    partitions = {}
+    for e in events:
+        partitions.setdefault(e.get(partition_by) or "unknown", []).append(e)
+
+    gc = _client()
+    ss = gc.open_by_key(spreadsheet_id)
+    titles = {key: f"{worksheet_name}_{key}" for key in partitions}
+    # Partitions that got no events this time are emptied rather than left with old rows
+    for title in _partition_titles(ss, worksheet_name) or []:
+        if title not in titles.values():
+            partitions[title] = []
+            titles[title] = title
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=SHEETS_MAX_WORKERS) as pool:
+        # Each write runs in a copy of this context, so e.g. the profiler attributes the writer threads to the sink
+        futures = {
+            key: pool.submit(contextvars.copy_context().run, _write_partition, ss, titles[key], rows)
+            for key, rows in partitions.items()
+        }
+        counts = {key: fut.result() for key, fut in futures.items()}
+
+    refreshed_at = _now_iso()
+    index = [INDEX_COLUMNS] + [[key, titles[key], counts[key], refreshed_at] for key in sorted(counts) if counts[key]]
+    ws = _with_retry(lambda: get_or_create_worksheet(ss, _index_title(worksheet_name), INDEX_COLUMNS))
+    # Overwrite, then trim, so readers never see an empty index
+    _with_retry(lambda: ws.update("A1", index))
+    _with_retry(lambda: ws.resize(rows=len(index)))
+
+    summary = ", ".join(f"{titles[key]}={counts[key]}" for key in sorted(counts))
+    print(f"Events written: {len(events)} across {len(counts)} worksheets in {time.perf_counter() - t0:.1f}s ({summary})")
+    return len(events)
+
+def upsert_events(spreadsheet_id, worksheet_name, events, partition_by=None):
+    """
+    partition_by: None writes every event to `worksheet_name`; "source" or "signal_type"
+    writes each group to its own "<worksheet_name>_<value>" worksheet instead.
+    """
+    if partition_by:
+        return _upsert_partitioned(spreadsheet_id, worksheet_name, events, partition_by)
+
     gc = _client()
     ws = gc.open_by_key(spreadsheet_id).worksheet(worksheet_name)
     ws.clear()
+    if ws.col_count < len(COLUMNS):
+        ws.add_cols(len(COLUMNS) - ws.col_count)
     rows = [COLUMNS]
     for e in events:
         rows.append([e.get(col, "") for col in COLUMNS])
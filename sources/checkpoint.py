@@ -0,0 +1,40 @@
+import time
+
+
+class Checkpointer:
+    """
+    Buffers new cache entries during an enrichment loop and hands them to `flush_fn`
+    every `every` items or `interval` seconds, so an interrupted run keeps the work
+    done so far and the next run resumes from the last flushed batch.
+    """
+
+    def __init__(self, flush_fn=None, every: int = 25, interval: float = 120.0):
+        self.flush_fn = flush_fn
+        self.every = every
+        self.interval = interval
+        self.pending = []
+        self.flushed = 0
+        self._flush_at = every
+        self._last_flush = time.monotonic()
+
+    def add(self, item):
+        self.pending.append(item)
+        if len(self.pending) >= self._flush_at or time.monotonic() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self.pending or self.flush_fn is None:
+            return
+        batch = self.pending
+        try:
+            self.flush_fn(batch)
+        except Exception as ex:
+            # Keep the batch, but wait for `every` more items or `interval` seconds before
+            # retrying so a throttled sink isn't hit again on every add
+            self._flush_at = len(batch) + self.every
+            print(f"Warning: checkpoint flush failed ({len(batch)} entries pending): {ex}")
+            return
+        self.pending = []
+        self._flush_at = self.every
+        self.flushed += len(batch)
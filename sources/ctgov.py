@@ -1,6 +1,6 @@
 import hashlib
 from datetime import datetime, timezone, timedelta
-import requests
+from sources import http_client
 
 CTGOV_API = "https://clinicaltrials.gov/api/v2/studies"
 
@@ -43,7 +43,7 @@ def fetch_phase3_recent(days_back: int = 90, page_size: int = 100, max_pages: in
         elif "pageToken" in params:
             del params["pageToken"]
 
-        r = requests.get(CTGOV_API, params=params, timeout=30)
+        r = http_client.get(CTGOV_API, params=params, timeout=30)
         r.raise_for_status()
         data = r.json()
 
@@ -1,12 +1,27 @@
+import contextvars
 import hashlib
 import json
-import time
-import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
+from sources import http_client
+from sources.checkpoint import Checkpointer
+
+try:
+    import ijson
+except ImportError:  # fall back to decoding whole retrieve documents
+    ijson = None
 
 OVERVIEW_URL = "https://euclinicaltrials.eu/ctis-public-api/search"
 RETRIEVE_URL = "https://euclinicaltrials.eu/ctis-public-api/retrieve"
 
+# The only parts of a retrieve document the extractors read
+_PRODUCTS_PATH = "authorizedApplication.authorizedPartI.products"
+_DECISION_DATE_PATH = "decisionDate"
+# Cleared by _parse_detail when the document layout doesn't allow stopping early
+_stream_details = True
+# Google Sheets rejects cells over 50,000 characters
+MAX_SNAPSHOT_CHARS = 50000
+
 def _hash_id(*parts):
     return hashlib.sha256("||".join([p or "" for p in parts]).encode("utf-8")).hexdigest()[:20]
 
@@ -100,41 +115,191 @@ def _extract_start_date(detail):
     except Exception:
         return ""
 
-def enrich_ctis_trials(trials, cache):
+def _compact_product(p):
+    """Keeps just the product fields _extract_active_substance reads, in the same layout."""
+    info = p.get("productDictionaryInfo") or {}
+    return {
+        "part1MpRoleTypeCode": str(p.get("part1MpRoleTypeCode", "")),
+        "sponsorProductCodeEdit": p.get("sponsorProductCodeEdit") or "",
+        "productDictionaryInfo": {
+            "activeSubstanceName": info.get("activeSubstanceName") or "",
+            "nameOrg": info.get("nameOrg") or "",
+            "prodName": info.get("prodName") or "",
+            "productSubstances": [
+                {"synonyms": s.get("synonyms") or []} for s in info.get("productSubstances") or []
+            ],
+        },
+    }
+
+def _compact_detail(products, decision_date):
+    return {
+        "decisionDate": decision_date or "",
+        "authorizedApplication": {"authorizedPartI": {"products": [_compact_product(p) for p in products or []]}},
+    }
+
+class _Capture:
+    """Keeps the bytes read from `f`, so a streamed parse can still fall back to json.loads."""
+
+    def __init__(self, f):
+        self.f = f
+        self.chunks = []
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.chunks.append(data)
+        return data
+
+    def rest(self) -> bytes:
+        return b"".join(self.chunks) + self.f.read()
+
+def _load_detail(body: bytes) -> dict:
+    detail = json.loads(body)
+    products = detail.get("authorizedApplication", {}).get("authorizedPartI", {}).get("products", [])
+    return _compact_detail(products, detail.get("decisionDate"))
+
+def _parse_detail(f) -> dict:
+    """
+    Decodes only authorizedPartI.products and the top-level decisionDate from the
+    retrieve response stream `f` and returns them as a compact detail document.
+
+    Streaming pays off only when both turn up early: parsing stops there and the rest
+    of the body isn't even downloaded. Even with ijson's C backend a full token scan
+    costs about as much as json.loads, so once a document shows decisionDate after the
+    products, that one and all later ones are decoded whole with json.loads instead.
+    """
+    global _stream_details
+    if ijson is None or not _stream_details:
+        return _load_detail(f.read())
+
+    f = _Capture(f)
+    products = None
+    decision_date = None
+    builder = None
+    for prefix, event, value in ijson.parse(f):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == _PRODUCTS_PATH and event == "end_array":
+                products = builder.value
+                builder = None
+                if decision_date is None:
+                    _stream_details = False
+                    print("CTIS: decisionDate follows the products, decoding retrieve documents whole")
+                    return _load_detail(f.rest())
+        elif prefix == _PRODUCTS_PATH and event == "start_array":
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+        elif prefix == _DECISION_DATE_PATH:
+            decision_date = value or ""
+
+        if products is not None and decision_date is not None:
+            break
+
+    return _compact_detail(products, decision_date)
+
+def _snapshot(detail) -> str:
+    """Compact JSON of the investigational product data, stored in the CTIS cache."""
+    products = detail["authorizedApplication"]["authorizedPartI"]["products"]
+    snapshot = json.dumps(products, separators=(",", ":"), ensure_ascii=False)
+    return snapshot if len(snapshot) <= MAX_SNAPSHOT_CHARS else ""
+
+def _retrieve_trial(ct_number, sponsor):
+    """Returns (asset, aliases, start, snapshot, ok); ok is False if the retrieve failed."""
+    try:
+        with http_client.get(f"{RETRIEVE_URL}/{ct_number}", timeout=30, stream=True) as r:
+            r.raise_for_status()
+            detail = _parse_detail(http_client.body_stream(r))
+        asset, aliases = _extract_active_substance(detail, sponsor=sponsor)
+        start = _extract_start_date(detail)
+        snapshot = _snapshot(detail)
+    except Exception as ex:
+        print(f"Warning: could not retrieve CTIS {ct_number}: {ex}")
+        return "", "", "", "", False
+    return asset, aliases, start, snapshot, True
+
+def _apply_cached(t, cached):
+    snapshot = cached.get("products")
+    if snapshot:
+        # Re-derive from the stored products so heuristic changes apply without refetching
+        try:
+            products = json.loads(snapshot)
+        except ValueError:
+            products = []
+        detail = _compact_detail(products, cached["start_date"])
+        asset, aliases = _extract_active_substance(detail, sponsor=t.get("company", ""))
+        if asset:
+            t["asset_name"] = asset
+            t["aliases"] = aliases
+            t["start_date"] = cached["start_date"]
+            return
+    t["asset_name"] = cached["asset_name"]
+    t["aliases"] = cached.get("aliases", "")
+    t["start_date"] = cached["start_date"]
+
+def enrich_ctis_trials(trials, cache, checkpoint=None, checkpoint_every=25, checkpoint_interval=120.0):
+    """
+    Retrievals run on a thread pool; how many are actually in flight is decided by the
+    shared euclinicaltrials.eu controller in sources.http_client.
+
+    checkpoint: optional callable receiving {ct_number: entry} batches of new cache
+    entries as they accumulate; the last partial batch is flushed even if the loop fails.
+    """
     new_cache = {}
-    enriched = []
+    misses = []
+    failed = 0
 
     for t in trials:
-        ct_number = t["id"]
-
-        if ct_number in cache:
-            t["asset_name"] = cache[ct_number]["asset_name"]
-            t["aliases"] = cache[ct_number].get("aliases", "")
-            t["start_date"] = cache[ct_number]["start_date"]
-            enriched.append(t)
-            continue
+        cached = cache.get(t["id"])
+        if cached and not cached.get("stale"):
+            _apply_cached(t, cached)
+        else:
+            misses.append(t)
+
+    checkpointer = Checkpointer(
+        checkpoint and (lambda batch: checkpoint(dict(batch))),
+        every=checkpoint_every,
+        interval=checkpoint_interval,
+    )
+    pool = ThreadPoolExecutor(max_workers=http_client.controller_for(RETRIEVE_URL).max_concurrency)
 
-        try:
-            r = requests.get(f"{RETRIEVE_URL}/{ct_number}", timeout=30)
-            r.raise_for_status()
-            detail = r.json()
-            asset, aliases = _extract_active_substance(detail, sponsor=t.get("company", ""))
-            start = _extract_start_date(detail)
-        except Exception as ex:
-            print(f"Warning: could not retrieve CTIS {ct_number}: {ex}")
-            asset = ""
-            aliases = ""
-            start = ""
-
-        t["asset_name"] = asset
-        t["aliases"] = aliases
-        t["start_date"] = start
-        new_cache[ct_number] = {"asset_name": asset, "aliases": aliases, "start_date": start}
-        enriched.append(t)
-        time.sleep(0.5)
-
-    print(f"CTIS enriched: {len(enriched)} trials, {len(new_cache)} new cache entries")
-    return enriched, new_cache
+    try:
+        # Each task runs in a copy of this context so the stage's cancellation scope applies in the pool
+        futures = {
+            pool.submit(contextvars.copy_context().run, _retrieve_trial, t["id"], t.get("company", "")): t
+            for t in misses
+        }
+        for fut in as_completed(futures):
+            t = futures[fut]
+            ct_number = t["id"]
+            asset, aliases, start, snapshot, ok = fut.result()
+
+            cached = cache.get(ct_number)
+            if not ok:
+                failed += 1
+                if not cached:
+                    # Nothing to fall back to; not cached, so it's retried next run
+                    t["asset_name"] = ""
+                    t["aliases"] = ""
+                    t["start_date"] = ""
+                    continue
+                # Refresh of an expired entry failed: keep serving the old value and re-save it
+                # with a new fetched_at, so it doesn't come due (and take refresh budget) every run
+                _apply_cached(t, cached)
+                asset = cached["asset_name"]
+                aliases = cached.get("aliases", "")
+                start = cached["start_date"]
+                snapshot = cached.get("products", "")
+            else:
+                t["asset_name"] = asset
+                t["aliases"] = aliases
+                t["start_date"] = start
+            new_cache[ct_number] = {"asset_name": asset, "aliases": aliases, "start_date": start, "products": snapshot}
+            checkpointer.add((ct_number, new_cache[ct_number]))
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        checkpointer.flush()
+
+    print(f"CTIS enriched: {len(trials)} trials, {len(new_cache)} new cache entries, {failed} retrieves failed")
+    return trials, new_cache
 
 def fetch_ctis_phase3(page_size: int = 200, max_pages: int = 10):
     now = datetime.now(timezone.utc)
@@ -164,7 +329,7 @@ def fetch_ctis_phase3(page_size: int = 200, max_pages: int = 10):
             },
         }
 
-        r = requests.post(
+        r = http_client.post(
             OVERVIEW_URL,
             headers={"Content-Type": "application/json"},
             data=json.dumps(payload),
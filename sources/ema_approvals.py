@@ -1,6 +1,8 @@
 import hashlib
+import io
 import pandas as pd
 from datetime import datetime, timezone
+from sources import http_client
 
 EPAR_URL = "https://www.ema.europa.eu/en/documents/report/medicines-output-medicines-report_en.xlsx"
 
@@ -12,7 +14,9 @@ def fetch_ema_approvals():
     cutoff_year = now.year - 1
 
     try:
-        df = pd.read_excel(EPAR_URL, header=8)
+        r = http_client.get(EPAR_URL, backoff=30.0, timeout=120)
+        r.raise_for_status()
+        df = pd.read_excel(io.BytesIO(r.content), header=8)
     except Exception as ex:
         print(f"Warning: could not load EMA approvals dataset: {ex}")
         return []
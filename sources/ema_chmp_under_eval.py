@@ -1,9 +1,10 @@
 import hashlib
-import time
+import io
 import pandas as pd
 import requests
 from bs4 import BeautifulSoup
 from datetime import datetime, timezone
+from sources import http_client
 
 EMA_UNDER_EVAL_PAGE = "https://www.ema.europa.eu/en/medicines/medicines-human-use-under-evaluation"
 
@@ -11,15 +12,7 @@ def _hash_id(*parts: str) -> str:
     return hashlib.sha256("||".join([p or "" for p in parts]).encode("utf-8")).hexdigest()[:20]
 
 def _get_with_retry(url: str, retries: int = 3, backoff: float = 30.0, **kwargs) -> requests.Response:
-    for attempt in range(retries):
-        r = requests.get(url, **kwargs)
-        if r.status_code == 429:
-            wait = backoff * (attempt + 1)
-            print(f"EMA rate limited (429), waiting {wait}s before retry {attempt + 1}/{retries}...")
-            time.sleep(wait)
-            continue
-        r.raise_for_status()
-        return r
+    r = http_client.get(url, retries=retries, backoff=backoff, **kwargs)
     r.raise_for_status()
     return r
 
@@ -37,7 +30,8 @@ def _latest_under_eval_xlsx_url() -> str:
 def fetch_ema_under_review_chmp():
     now = datetime.now(timezone.utc)
     xlsx_url = _latest_under_eval_xlsx_url()
-    df = pd.read_excel(xlsx_url, header=14)
+    r = _get_with_retry(xlsx_url, timeout=120)
+    df = pd.read_excel(io.BytesIO(r.content), header=14)
     events = []
     for _, row in df.iterrows():
         inn = str(row.get("International non-proprietary name (INN) / Common Name", "")).strip()
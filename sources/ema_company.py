@@ -1,5 +1,7 @@
-import time
-import requests
+import re
+from collections import Counter, defaultdict
+from sources import http_client
+from sources.checkpoint import Checkpointer
 
 CTGOV_API = "https://clinicaltrials.gov/api/v2/studies"
 
@@ -10,7 +12,7 @@ def _lookup_company_ctgov(inn: str) -> dict:
             "filter.advanced": "AREA[LeadSponsorClass]INDUSTRY",
             "pageSize": 3,
         }
-        r = requests.get(CTGOV_API, params=params, timeout=20)
+        r = http_client.get(CTGOV_API, params=params, timeout=20)
         r.raise_for_status()
         data = r.json()
         studies = data.get("studies", [])
@@ -24,41 +26,119 @@ def _lookup_company_ctgov(inn: str) -> dict:
                 return {"company": company, "nct_id": nct_id}
     except Exception as ex:
         print(f"Warning: CT.gov lookup failed for {inn}: {ex}")
+        return {"company": "", "nct_id": "", "failed": True}
     return {"company": "", "nct_id": ""}
 
-def enrich_ema_companies(events, company_map):
-    new_entries = []
+_PAREN_RE = re.compile(r"^(.*?)\s*\(([^)]*)\)\s*$")
 
-    for e in events:
-        inn = (e.get("asset_name") or "").strip()
-        ema_no = (e.get("id") or "").strip()
+def _name_keys(name: str) -> list[str]:
+    """'MK-3475 (Pembrolizumab)' -> ['mk-3475 (pembrolizumab)', 'mk-3475', 'pembrolizumab']"""
+    name = " ".join((name or "").lower().split())
+    if not name:
+        return []
+    keys = [name]
+    m = _PAREN_RE.match(name)
+    if m:
+        keys += [k.strip() for k in m.groups() if k.strip()]
+    return keys
 
-        if not inn:
+def build_intervention_index(ctgov_events) -> dict:
+    """
+    Maps intervention names and otherNames of already-fetched CT.gov events to
+    {"company", "nct_id"}. When several sponsors run trials with the same name the most
+    frequent one wins, matching what a lookup of the INN would usually return.
+    """
+    sponsors = defaultdict(Counter)
+    nct_ids = {}
+    for e in ctgov_events:
+        company = (e.get("company") or "").strip()
+        if not company:
             continue
+        for name in [e.get("asset_name", "")] + (e.get("aliases") or "").split(";"):
+            for key in _name_keys(name):
+                sponsors[key][company] += 1
+                nct_ids.setdefault((key, company), e.get("id", ""))
 
-        inn_key = inn.lower()
+    index = {}
+    for key, counts in sponsors.items():
+        company = counts.most_common(1)[0][0]
+        index[key] = {"company": company, "nct_id": nct_ids[(key, company)]}
+    return index
 
-        if inn_key in company_map:
-            e["company"] = company_map[inn_key]["company"]
-            continue
+def enrich_ema_companies(events, company_map, checkpoint=None, checkpoint_every=25, checkpoint_interval=120.0,
+                         ctgov_index=None):
+    """
+    Resolution order per INN: fresh company map entry, then `ctgov_index` (see
+    build_intervention_index), then a CT.gov network lookup.
+
+    checkpoint: optional callable receiving lists of new company map entries as they
+    accumulate; the last partial batch is flushed even if the loop fails.
+    """
+    ctgov_index = ctgov_index or {}
+    new_entries = []
+    index_hits = 0
+    failed = set()   # INNs whose lookup failed this run; not looked up again
+    checkpointer = Checkpointer(checkpoint, every=checkpoint_every, interval=checkpoint_interval)
+
+    try:
+        for e in events:
+            inn = (e.get("asset_name") or "").strip()
+            ema_no = (e.get("id") or "").strip()
+
+            if not inn:
+                continue
+
+            inn_key = inn.lower()
+
+            cached = company_map.get(inn_key)
+
+            if cached and not cached.get("stale"):
+                e["company"] = cached["company"]
+                continue
+            if inn_key in failed:
+                e["company"] = cached["company"] if cached else ""
+                continue
 
-        result = _lookup_company_ctgov(inn)
-        company = result["company"]
-        nct_id = result["nct_id"]
+            indexed = ctgov_index.get(" ".join(inn_key.split()))
+            if indexed:
+                index_hits += 1
+                result = indexed
+                source = "ctgov_index"
+            else:
+                result = _lookup_company_ctgov(inn)
+                source = "ctgov"
+            company = result["company"]
+            nct_id = result["nct_id"]
 
-        e["company"] = company
-        company_map[inn_key] = {"company": company, "nct_id": nct_id}
+            if result.get("failed"):
+                failed.add(inn_key)
+                if not cached:
+                    # Nothing to fall back to; not cached, so it's retried next run
+                    e["company"] = ""
+                    continue
+                # Refresh of an expired entry failed: keep the old sponsor and re-save it with
+                # a new fetched_at, so it doesn't come due (and take refresh budget) every run
+                company = cached["company"]
+                nct_id = cached.get("nct_id", "")
+                source = cached.get("source", "")
 
-        new_entries.append({
-            "inn": inn,
-            "ema_no": ema_no,
-            "company": company,
-            "source": "ctgov",
-            "nct_id": nct_id,
-        })
+            e["company"] = company
+            company_map[inn_key] = {"company": company, "nct_id": nct_id}
 
-        time.sleep(0.3)
+            new_entries.append({
+                "inn": inn,
+                "ema_no": ema_no,
+                "company": company,
+                "source": source,
+                "nct_id": nct_id,
+            })
+            checkpointer.add(new_entries[-1])
+    finally:
+        checkpointer.flush()
 
     found = sum(1 for e in new_entries if e["company"])
-    print(f"EMA company lookup: {len(new_entries)} queried, {found} found")
+    hit_rate = index_hits / len(new_entries) if new_entries else 0.0
+    print(f"EMA company lookup: {len(new_entries)} resolved, {found} found; "
+          f"CT.gov index hits {index_hits} ({hit_rate:.0%}), network lookups {len(new_entries) - index_hits}, "
+          f"{len(failed)} failed")
     return events, new_entries
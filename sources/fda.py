@@ -1,10 +1,10 @@
 import hashlib
 import re
-import requests
 import zipfile
 import io
 import json
 from datetime import datetime, timezone
+from sources import http_client
 
 FDA_DOWNLOAD_URL = "https://api.fda.gov/download.json"
 
@@ -25,7 +25,7 @@ def fetch_fda_approvals():
     now = datetime.now(timezone.utc)
     cutoff = f"{now.year - 1}0101"
 
-    r = requests.get(FDA_DOWNLOAD_URL, timeout=30)
+    r = http_client.get(FDA_DOWNLOAD_URL, timeout=30)
     r.raise_for_status()
     manifest = r.json()
 
@@ -47,7 +47,7 @@ def fetch_fda_approvals():
         if not url:
             continue
 
-        r = requests.get(url, timeout=120)
+        r = http_client.get(url, timeout=120)
         r.raise_for_status()
 
         with zipfile.ZipFile(io.BytesIO(r.content)) as z:
@@ -135,7 +135,7 @@ def fetch_fda_adcom():
             "&per_page=40"
             "&order=newest"
         )
-        r = requests.get(url, timeout=30)
+        r = http_client.get(url, timeout=30)
         r.raise_for_status()
         data = r.json()
 
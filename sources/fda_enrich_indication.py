@@ -4,20 +4,43 @@ fda_enrich_indication.py
 Post-process FDA approval events to populate indication_raw
 using the openFDA drug label API.
 
-Integration in tracker.py:
-    from fda_enrich_indication import enrich_fda_indications
-    fda_events = fetch_fda_under_review()
-    fda_events = enrich_fda_indications(fda_events)   # <-- add this line
+Integration in tracker.py: run_fda calls enrich_fda_indications when a backend is
+chosen with --fda-labels api|local or FDA_LABEL_BACKEND; it is off otherwise.
 
 openFDA rate limit: 240 req/min without API key, 1000/min with key.
-Set OPENFDA_API_KEY env var to use authenticated requests.
+Requests are paced by the shared api.fda.gov controller in sources.http_client.
+
+Local backend (FDA_LABEL_BACKEND=local or backend="local"):
+    Streams the drug/label bulk partitions listed in download.json to temporary files
+    and from there, label by label, into a local index of application number -> first
+    indication sentence (FDA_LABEL_INDEX_PATH, gzipped JSON). Every enrichment run
+    re-checks the manifest and rebuilds the index only when its export_date changes;
+    lookups then need no API calls at all. If no index can be built the run falls back
+    to the label API. A rebuild saves its progress after every partition and resumes
+    on the next run if the FDA stage deadline cuts it short.
+
+    FDA_LABEL_INDEX_PATH must be on storage that outlives the run (the GitHub workflow
+    caches .cache/), otherwise every run downloads the whole export again.
 """
 
+import gzip
+import json
+import os
 import re
-import time
-import requests
+import tempfile
+import zipfile
+from sources import http_client
+
+try:
+    import ijson
+except ImportError:  # fall back to loading each partition file whole
+    ijson = None
 
 OPENFDA_LABEL_URL = "https://api.fda.gov/drug/label.json"
+FDA_DOWNLOAD_URL = "https://api.fda.gov/download.json"
+LABEL_INDEX_PATH = os.environ.get("FDA_LABEL_INDEX_PATH", ".cache/fda_label_index.json.gz")
+
+_label_index = None   # {"export_date": ..., "index": {...}} once loaded
 
 # Regex to extract NDA/BLA number from summary field
 # e.g. "NDA219616/1; Brand: ..." or "BLA761464/1; Brand: ..."
@@ -44,7 +67,7 @@ def _fetch_indication(app_type: str, app_number: str) -> str:
     query = f'openfda.application_number:"{app_type}{app_number}"'
 
     try:
-        r = requests.get(
+        r = http_client.get(
             OPENFDA_LABEL_URL,
             params={"search": query, "limit": 1},
             timeout=10
@@ -57,30 +80,167 @@ def _fetch_indication(app_type: str, app_number: str) -> str:
         if not results:
             return ""
 
-        label = results[0]
-
-        # Try indications_and_usage first, then purpose, then description
-        for field in ["indications_and_usage", "purpose", "description"]:
-            val = label.get(field)
-            if val and isinstance(val, list) and val[0]:
-                text = val[0].strip()
-                # Truncate to first sentence or 300 chars to keep it clean
-                first_sentence = re.split(r'(?<=[.!?])\s', text)[0]
-                return first_sentence[:300]
-
-        return ""
+        return _first_indication(results[0])
 
     except Exception:
         return ""
 
 
-def enrich_fda_indications(events: list[dict], delay: float = 0.25) -> list[dict]:
+def _first_indication(label: dict) -> str:
+    # Try indications_and_usage first, then purpose, then description
+    for field in ["indications_and_usage", "purpose", "description"]:
+        val = label.get(field)
+        if val and isinstance(val, list) and val[0]:
+            text = val[0].strip()
+            # Truncate to first sentence or 300 chars to keep it clean
+            first_sentence = re.split(r'(?<=[.!?])\s', text)[0]
+            return first_sentence[:300]
+    return ""
+
+
+def _iter_labels(f):
+    if ijson is not None:
+        # Stream label by label instead of materializing the whole partition file
+        yield from ijson.items(f, "results.item")
+    else:
+        yield from json.load(f).get("results", [])
+
+
+def _download(url: str, f):
+    """Streams a bulk partition into the file object `f` without holding it in memory."""
+    r = http_client.get(url, timeout=300, stream=True)
+    try:
+        r.raise_for_status()
+        for chunk in r.iter_content(chunk_size=1 << 20):
+            f.write(chunk)
+    finally:
+        r.close()
+    f.seek(0)
+
+
+def _read_label_index(path: str) -> dict | None:
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_label_index(path: str, data: dict):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+def _index_partition(f, index: dict):
+    with zipfile.ZipFile(f) as z:
+        for fname in z.namelist():
+            if not fname.endswith(".json"):
+                continue
+            with z.open(fname) as member:
+                for label in _iter_labels(member):
+                    app_numbers = (label.get("openfda") or {}).get("application_number") or []
+                    if not app_numbers:
+                        continue
+                    indication = _first_indication(label)
+                    if not indication:
+                        continue
+                    for app_no in app_numbers:
+                        index.setdefault(app_no.strip().upper(), indication)
+
+
+def _refresh_label_index(path: str, existing: dict | None, force: bool = False) -> dict:
+    """
+    Returns {"export_date": ..., "index": {...}}: `existing` if the manifest still lists
+    its export date, otherwise a new index built from the bulk export and saved to `path`.
+    Keeps `existing` if the rebuild fails; raises only when there is nothing to keep.
+
+    Progress is saved to "<path>.partial" after every partition, so a rebuild cut short
+    (e.g. by the FDA stage deadline) resumes with the remaining partitions next run.
+    """
+    partial_path = f"{path}.partial"
+    try:
+        r = http_client.get(FDA_DOWNLOAD_URL, timeout=30)
+        r.raise_for_status()
+        label_export = r.json().get("results", {}).get("drug", {}).get("label", {})
+        export_date = label_export.get("export_date", "")
+        urls = [p["file"] for p in label_export.get("partitions", []) if p.get("file")]
+
+        if existing and existing.get("export_date") == export_date and not force:
+            print(f"FDA label index up to date (export {export_date}): {len(existing['index'])} applications")
+            return existing
+        if not urls:
+            raise RuntimeError("no drug/label partitions in download.json")
+
+        partial = _read_label_index(partial_path)
+        if not partial or partial.get("export_date") != export_date or force:
+            partial = {"export_date": export_date, "done": [], "index": {}}
+        elif partial["done"]:
+            print(f"FDA label index: resuming export {export_date} after {len(partial['done'])}/{len(urls)} partitions")
+
+        for url in urls:
+            if url in partial["done"]:
+                continue
+            with tempfile.TemporaryFile() as tmp:
+                _download(url, tmp)
+                _index_partition(tmp, partial["index"])
+            partial["done"].append(url)
+            _write_label_index(partial_path, partial)
+    except Exception as ex:
+        if existing:
+            print(f"Warning: could not refresh FDA label index, using export {existing.get('export_date')}: {ex}")
+            return existing
+        raise
+
+    data = {"export_date": export_date, "index": partial["index"]}
+    _write_label_index(path, data)
+    os.remove(partial_path)
+    print(f"FDA label index built (export {export_date}): {len(data['index'])} applications from {len(urls)} partitions")
+    return data
+
+
+def build_label_index(path: str = LABEL_INDEX_PATH, force: bool = False) -> dict:
+    """
+    Returns {application_number: indication} from the local index at `path`, rebuilding
+    it from the openFDA drug/label bulk export when the export date has changed (or
+    `force`). Keeps the existing index if the rebuild fails.
+    """
+    return _refresh_label_index(path, _read_label_index(path), force)["index"]
+
+
+def _current_label_index() -> dict | None:
+    """
+    The in-memory index, re-checked against the manifest on every call so long-running
+    processes pick up new exports. None if no index exists and it can't be built.
+    """
+    global _label_index
+    existing = _label_index or _read_label_index(LABEL_INDEX_PATH)
+    try:
+        _label_index = _refresh_label_index(LABEL_INDEX_PATH, existing)
+    except Exception as ex:
+        print(f"Warning: FDA label index unavailable, falling back to the label API: {ex}")
+        return None
+    return _label_index["index"]
+
+
+def enrich_fda_indications(events: list[dict], backend: str | None = None) -> list[dict]:
     """
     For each FDA event with missing indication_raw, query openFDA label API.
     Modifies events in place and returns the list.
 
-    delay: seconds between API calls to avoid rate limiting (openFDA: 240 req/min)
+    backend: "api" or "local" for the bulk-export index; FDA_LABEL_BACKEND (default "api") if None
     """
+    backend = backend or os.environ.get("FDA_LABEL_BACKEND", "api")
+    if backend not in ("api", "local"):
+        raise ValueError(f"Unknown FDA label backend: {backend!r}")
+    lookup = _fetch_indication
+    if backend == "local":
+        index = _current_label_index()
+        if index is not None:
+            lookup = lambda app_type, app_number: index.get(f"{app_type}{app_number}", "")
+
     enriched = 0
     skipped = 0
 
@@ -103,13 +263,11 @@ def enrich_fda_indications(events: list[dict], delay: float = 0.25) -> list[dict
         if not app_number:
             continue
 
-        indication = _fetch_indication(app_type, app_number)
+        indication = lookup(app_type, app_number)
 
         if indication:
             event["indication_raw"] = indication
             enriched += 1
 
-        time.sleep(delay)  # Rate limiting
-
     print(f"FDA indication enrichment: {enriched} enriched, {skipped} already had indication")
     return events
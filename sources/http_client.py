@@ -0,0 +1,388 @@
+"""
+Shared HTTP access for all sources.
+
+Every request goes through a per-host controller that adapts the allowed request
+rate and the number of requests in flight AIMD-style: both grow additively while
+the host answers quickly, and are halved on 429/5xx responses, connection errors
+or responses slower than the host's latency target. This replaces the fixed
+per-source sleeps, so each source runs close to what its upstream can take.
+
+Exchanges can also be recorded into a zip archive (start_recording) and served
+back later without any network access (start_replay), optionally sleeping for
+the recorded latencies. The archive holds one deflated body per response plus an
+index.json with status, headers and timing, and "blobs/" for extra state such as
+the enrichment caches a recorded run started from.
+
+A stage can be cancelled by running it inside cancel_scope(event): once the event is
+set, every request made from that scope (including pool threads started with a copy
+of its context) raises StageCancelled instead of going out.
+"""
+
+import contextvars
+import hashlib
+import io
+import json
+import re
+import threading
+import time
+import zipfile
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# Starting points roughly match the fixed sleeps the sources used before
+# (CTIS 0.5 s, CT.gov 0.3 s, openFDA 0.25 s); openFDA caps anonymous use at 240 req/min.
+HOST_DEFAULTS = {
+    "euclinicaltrials.eu": {"rate": 2.0},
+    "clinicaltrials.gov": {"rate": 3.0},
+    "api.fda.gov": {"rate": 4.0, "max_rate": 4.0},
+    "www.ema.europa.eu": {"rate": 1.0, "max_concurrency": 2, "target_latency": 30.0},
+    # Bulk partition downloads: large bodies, slow is normal
+    "download.open.fda.gov": {"target_latency": 120.0},
+}
+
+RATE_STEP = 0.1           # req/s added per healthy response
+CONCURRENCY_EVERY = 10    # healthy responses needed to allow one more request in flight
+DECREASE_FACTOR = 0.5
+DECREASE_COOLDOWN = 1.0   # seconds; one congestion episode only halves the limits once
+
+# Bodies are stored decoded, so these no longer describe them
+_DROPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+# Calendar dates in query strings (e.g. CT.gov completion windows) are ignored when
+# matching, so a capture still replays on a later day
+_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+_session = requests.Session()
+_controllers = {}
+_controllers_lock = threading.Lock()
+_recorder = None
+_replayer = None
+_cancel_event = contextvars.ContextVar("http_client_cancel_event", default=None)
+
+
+class StageCancelled(BaseException):
+    """
+    Raised by requests made after the surrounding stage was cancelled. Like
+    KeyboardInterrupt it derives from BaseException, so the sources' `except Exception`
+    handlers don't record cancelled lookups as ordinary failures.
+    """
+
+
+@contextmanager
+def cancel_scope(event):
+    token = _cancel_event.set(event)
+    try:
+        yield
+    finally:
+        _cancel_event.reset(token)
+
+
+def _check_cancelled():
+    event = _cancel_event.get()
+    if event is not None and event.is_set():
+        raise StageCancelled()
+
+
+def _sleep(seconds):
+    """time.sleep that wakes up early and raises if the current stage is cancelled."""
+    event = _cancel_event.get()
+    if event is None:
+        time.sleep(seconds)
+    elif event.wait(seconds):
+        raise StageCancelled()
+
+
+class HostController:
+    def __init__(self, host, rate=2.0, min_rate=0.1, max_rate=20.0,
+                 concurrency=1, max_concurrency=8, target_latency=10.0):
+        self.host = host
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+
+        self.requests = 0
+        self.throttled = 0
+        self._in_flight = 0
+        self._next_start = 0.0
+        self._healthy = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def describe(self):
+        return f"{self.rate:.2f} req/s, concurrency {self.concurrency}"
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                _check_cancelled()
+                now = time.monotonic()
+                if self._in_flight < self.concurrency:
+                    if now >= self._next_start:
+                        break
+                    self._cond.wait(min(self._next_start - now, 1.0))
+                else:
+                    # Wake up periodically to notice cancellation
+                    self._cond.wait(1.0)
+            self._in_flight += 1
+            self._next_start = max(now, self._next_start) + 1.0 / self.rate
+
+    def release(self, status, latency):
+        """status is the HTTP status code, or 0 if the request failed without a response."""
+        with self._cond:
+            self._in_flight -= 1
+            self.requests += 1
+            if status == 429 or status == 0 or status >= 500:
+                self.throttled += 1
+                self._decrease(f"HTTP {status}" if status else "request failed")
+            elif latency > self.target_latency:
+                self._decrease(f"slow response ({latency:.1f}s)")
+            else:
+                self._increase()
+            self._cond.notify_all()
+
+    def _increase(self):
+        self.rate = min(self.max_rate, self.rate + RATE_STEP)
+        self._healthy += 1
+        if self._healthy % CONCURRENCY_EVERY == 0 and self.concurrency < self.max_concurrency:
+            self.concurrency += 1
+            print(f"HTTP {self.host}: raising limits to {self.describe()}")
+
+    def _decrease(self, reason):
+        self._healthy = 0
+        now = time.monotonic()
+        if now - self._last_decrease < DECREASE_COOLDOWN:
+            return
+        self._last_decrease = now
+        self.rate = max(self.min_rate, self.rate * DECREASE_FACTOR)
+        self.concurrency = max(1, int(self.concurrency * DECREASE_FACTOR))
+        # Let in-flight slots drain before the next start at the reduced rate
+        self._next_start = now + 1.0 / self.rate
+        print(f"HTTP {self.host}: {reason}, backing off to {self.describe()}")
+
+
+def controller_for(url):
+    host = urlsplit(url).hostname or ""
+    with _controllers_lock:
+        ctl = _controllers.get(host)
+        if ctl is None:
+            ctl = _controllers[host] = HostController(host, **HOST_DEFAULTS.get(host, {}))
+        return ctl
+
+
+def limits():
+    """Current limits and counters per host, e.g. for the daemon's metrics endpoint."""
+    with _controllers_lock:
+        return {
+            host: {"rate": ctl.rate, "concurrency": ctl.concurrency, "requests": ctl.requests, "throttled": ctl.throttled}
+            for host, ctl in _controllers.items()
+        }
+
+
+def log_limits():
+    for host, ctl in sorted(_controllers.items()):
+        print(f"HTTP {host}: {ctl.describe()}; {ctl.requests} requests, {ctl.throttled} throttled/failed")
+
+
+class ReplayMiss(requests.ConnectionError):
+    """Raised in replay mode for a request that isn't in the archive."""
+
+
+def _request_key(method, url, params=None, data=None, json_body=None):
+    prepared = requests.Request(method, url, params=params).prepare().url
+    body = data if data is not None else (json.dumps(json_body, sort_keys=True) if json_body is not None else "")
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    digest = hashlib.sha256(body).hexdigest()[:16] if body else ""
+    return f"{method} {_DATE_RE.sub('<date>', prepared)} {digest}"
+
+
+class Recorder:
+    def __init__(self, path):
+        self.path = path
+        self._zip = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED)
+        self._index = []
+        self._lock = threading.Lock()
+
+    def add(self, key, r, elapsed):
+        with self._lock:
+            body = f"bodies/{len(self._index):06d}"
+            self._zip.writestr(body, r.content)
+            self._index.append({
+                "key": key,
+                "url": r.url,
+                "status": r.status_code,
+                "reason": r.reason,
+                "encoding": r.encoding,
+                "headers": {k: v for k, v in r.headers.items() if k.lower() not in _DROPPED_HEADERS},
+                "elapsed": elapsed,
+                "body": body,
+            })
+
+    def put_blob(self, name, obj):
+        with self._lock:
+            self._zip.writestr(f"blobs/{name}.json", json.dumps(obj))
+
+    def close(self):
+        with self._lock:
+            self._zip.writestr("index.json", json.dumps(self._index))
+            self._zip.close()
+        print(f"HTTP recording saved: {len(self._index)} exchanges -> {self.path}")
+
+
+class Replayer:
+    def __init__(self, path, simulate_latency=False):
+        self.path = path
+        self.simulate_latency = simulate_latency
+        self._zip = zipfile.ZipFile(path)
+        self._entries = defaultdict(list)
+        for entry in json.loads(self._zip.read("index.json")):
+            self._entries[entry["key"]].append(entry)
+        self._served = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def response(self, key):
+        """Serves the recorded responses for `key` in order, repeating the last one."""
+        entries = self._entries.get(key)
+        if not entries:
+            raise ReplayMiss(f"No recorded response for {key}")
+        with self._lock:
+            entry = entries[min(self._served[key], len(entries) - 1)]
+            self._served[key] += 1
+            content = self._zip.read(entry["body"])
+        if self.simulate_latency:
+            _sleep(entry["elapsed"])
+
+        r = requests.Response()
+        r.status_code = entry["status"]
+        r.reason = entry["reason"]
+        r.url = entry["url"]
+        r.encoding = entry["encoding"]
+        r.headers = CaseInsensitiveDict(entry["headers"])
+        r.elapsed = timedelta(seconds=entry["elapsed"])
+        r._content = content
+        # Lets stream=True callers read it with iter_content
+        r._content_consumed = True
+        return r
+
+    def get_blob(self, name):
+        try:
+            with self._lock:
+                return json.loads(self._zip.read(f"blobs/{name}.json"))
+        except KeyError:
+            return None
+
+    def close(self):
+        self._zip.close()
+
+
+def start_recording(path):
+    global _recorder
+    _recorder = Recorder(path)
+    print(f"HTTP recording to {path}")
+
+
+def start_replay(path, simulate_latency=False):
+    global _replayer
+    _replayer = Replayer(path, simulate_latency=simulate_latency)
+    print(f"HTTP replaying from {path}" + (" with recorded latencies" if simulate_latency else ""))
+
+
+def stop():
+    """Closes the active recording (writing its index) or replay archive."""
+    global _recorder, _replayer
+    if _recorder is not None:
+        _recorder.close()
+        _recorder = None
+    if _replayer is not None:
+        _replayer.close()
+        _replayer = None
+
+
+def replaying():
+    return _replayer is not None
+
+
+def save_blob(name, obj):
+    """Stores `obj` in the archive when recording; no-op otherwise."""
+    if _recorder is not None:
+        _recorder.put_blob(name, obj)
+
+
+def load_blob(name):
+    return _replayer.get_blob(name) if _replayer is not None else None
+
+
+def body_stream(r):
+    """
+    File-like body of a stream=True response. Recorded and replayed responses are
+    already in memory; otherwise the socket is read directly, so a caller that stops
+    reading early (and closes the response) doesn't download the rest.
+    """
+    if r._content_consumed:
+        return io.BytesIO(r.content)
+    r.raw.decode_content = True
+    return r.raw
+
+
+def _retry_after(r, default):
+    try:
+        return max(float(r.headers.get("Retry-After", "")), 0.0)
+    except ValueError:
+        return default
+
+
+def request(method, url, retries=3, backoff=5.0, **kwargs) -> requests.Response:
+    """
+    Sends a request through the host's controller. 429 and 5xx responses are retried up
+    to `retries` attempts in total, waiting for Retry-After or a linear `backoff`. The last
+    response is returned as-is; callers still call raise_for_status() themselves.
+    """
+    key = _request_key(method, url, kwargs.get("params"), kwargs.get("data"), kwargs.get("json"))
+    _check_cancelled()
+    if _replayer is not None:
+        # Retries were recorded as separate exchanges and are served in the same order
+        for attempt in range(retries):
+            r = _replayer.response(key)
+            if (r.status_code == 429 or r.status_code >= 500) and attempt < retries - 1:
+                continue
+            return r
+        return r
+
+    ctl = controller_for(url)
+    for attempt in range(retries):
+        ctl.acquire()
+        t0 = time.monotonic()
+        try:
+            r = _session.request(method, url, **kwargs)
+        except requests.RequestException:
+            ctl.release(0, time.monotonic() - t0)
+            raise
+        elapsed = time.monotonic() - t0
+        ctl.release(r.status_code, elapsed)
+        if _recorder is not None:
+            _recorder.add(key, r, elapsed)
+
+        if (r.status_code == 429 or r.status_code >= 500) and attempt < retries - 1:
+            wait = _retry_after(r, backoff * (attempt + 1))
+            # Frees the connection of a stream=True response
+            r.close()
+            print(f"HTTP {ctl.host}: {r.status_code}, waiting {wait:.0f}s before retry {attempt + 1}/{retries - 1} ({ctl.describe()})")
+            _sleep(wait)
+            continue
+        return r
+    return r
+
+
+def get(url, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
@@ -1,52 +1,402 @@
+import argparse
+import contextlib
+import contextvars
+import importlib
 import os
-from sources.ctgov import fetch_phase3_recent
-from sources.ema_chmp_under_eval import fetch_ema_under_review_chmp
-from sources.ema_company import enrich_ema_companies
-from sources.ctis import fetch_ctis_phase3, enrich_ctis_trials
-from sources.fda import fetch_fda_under_review
-from sources.ema_approvals import fetch_ema_approvals
-from sinks.sheets import (
-    upsert_events, load_ctis_cache, save_ctis_cache,
-    load_ema_company_map, save_ema_company_map
-)
-
-
-def main():
-    spreadsheet_id = os.environ["SPREADSHEET_ID"]
-    worksheet = os.environ.get("WORKSHEET_NAME", "events")
-    days_back = int(os.environ.get("DAYS_BACK", "90"))
+import sys
+import threading
+import time
+from datetime import datetime, timezone
 
-    print("Running tracker...")
-    print("Days back (CTGOV):", days_back)
+_STARTED = time.perf_counter()
+
+# Stages run in this order; EVENT_ORDER is the order their rows appear in the events sheet
+SOURCES = ["ctgov", "ema_under_eval", "ctis", "fda", "ema_approvals"]
+EVENT_ORDER = ["ema_under_eval", "ema_approvals", "fda", "ctis", "ctgov"]
+
+# Per-stage deadlines in seconds (0 = none); override with --deadlines or STAGE_DEADLINES.
+# A stage past its deadline is cancelled and its previous rows are reused, marked stale.
+DEFAULT_DEADLINES = {
+    "ctgov": 600,
+    "ema_under_eval": 900,
+    "ctis": 2400,
+    "fda": 900,
+    "ema_approvals": 600,
+}
+# How long a cancelled stage gets to unwind (e.g. flush its checkpoint) before it's abandoned
+CANCEL_GRACE = 30
+
+_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+_import_seconds = 0.0
+
+
+def _import(module):
+    """Imports `module` on first use so only the chosen stages pay for pandas, bs4 or gspread."""
+    global _import_seconds
+    if module in sys.modules:
+        return sys.modules[module]
+    t0 = time.perf_counter()
+    mod = importlib.import_module(module)
+    elapsed = time.perf_counter() - t0
+    _import_seconds += elapsed
+    print(f"Imported {module} in {elapsed:.2f}s")
+    return mod
+
+
+def stage_of(event):
+    """Maps an event row back to the stage that produced it."""
+    if event.get("source") == "ema":
+        return "ema_approvals" if event.get("signal_type") == "ema_approval" else "ema_under_eval"
+    return event.get("source", "")
+
+
+def _load_cache(ctx, name, loader):
+    """
+    Loads an enrichment cache from Sheets. Recordings keep a copy so that replays start
+    from the same cache state without touching Sheets. When ctx has a "warm_caches" dict
+    (daemon mode) the loaded cache is kept there and reused by later runs.
+    """
+    warm = ctx.get("warm_caches")
+    if warm is not None and name in warm:
+        return warm[name]
+
+    http_client = _import("sources.http_client")
+    if http_client.replaying():
+        cache = http_client.load_blob(name) or {}
+    elif ctx["sink"]:
+        cache = loader(ctx["spreadsheet_id"])
+    else:
+        cache = {}
+    http_client.save_blob(name, cache)
+    if warm is not None:
+        warm[name] = cache
+    return cache
+
+
+def parse_durations(spec, defaults):
+    """'ctgov=6h,ctis=90m' -> `defaults` with those entries replaced, in seconds."""
+    durations = dict(defaults)
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, value = (p.strip() for p in part.partition("="))
+        try:
+            if value[-1:] in _UNITS:
+                seconds = float(value[:-1]) * _UNITS[value[-1]]
+            else:
+                seconds = float(value)
+        except ValueError:
+            seconds = -1
+        if name not in durations or seconds < 0:
+            raise ValueError(f"Invalid duration entry: {part!r}")
+        durations[name] = seconds
+    return durations
 
-    ctgov_events = fetch_phase3_recent(days_back=days_back)
 
-    ema_events = fetch_ema_under_review_chmp()
+def run_ctgov(ctx):
+    ctgov = _import("sources.ctgov")
+    return ctgov.fetch_phase3_recent(days_back=ctx["days_back"])
+
+
+def run_ema_under_eval(ctx):
+    chmp = _import("sources.ema_chmp_under_eval")
+    ema_company = _import("sources.ema_company")
+
+    ema_events = chmp.fetch_ema_under_review_chmp()
     print("EMA CHMP under evaluation fetched:", len(ema_events))
 
+    # Sponsors of the CT.gov studies fetched earlier in this run resolve most INNs without a request
+    ctgov_index = ema_company.build_intervention_index(ctx["results"].get("ctgov", []))
+    print(f"CT.gov intervention index: {len(ctgov_index)} names")
+
     print("Loading EMA company map...")
-    company_map = load_ema_company_map(spreadsheet_id)
+    company_map = _load_cache(ctx, "ema_company_map", lambda sid: _import("sinks.sheets").load_ema_company_map(sid))
     print(f"EMA company map loaded: {len(company_map)} entries")
-    ema_events, new_company_entries = enrich_ema_companies(ema_events, company_map)
-    save_ema_company_map(spreadsheet_id, new_company_entries)
 
-    ctis_events = fetch_ctis_phase3()
+    checkpoint = None
+    if ctx["sink"]:
+        sheets = _import("sinks.sheets")
+        # New entries are saved in batches while enriching, so a crashed run resumes from the last checkpoint
+        checkpoint = lambda batch: sheets.save_ema_company_map(ctx["spreadsheet_id"], batch)
+
+    ema_events, _ = ema_company.enrich_ema_companies(
+        ema_events, company_map,
+        checkpoint=checkpoint,
+        checkpoint_every=ctx["checkpoint_every"], checkpoint_interval=ctx["checkpoint_interval"],
+        ctgov_index=ctgov_index,
+    )
+    return ema_events
+
+
+def run_ctis(ctx):
+    ctis = _import("sources.ctis")
+
+    ctis_events = ctis.fetch_ctis_phase3()
 
     print("Loading CTIS cache...")
-    ctis_cache = load_ctis_cache(spreadsheet_id)
+    ctis_cache = _load_cache(ctx, "ctis_cache", lambda sid: _import("sinks.sheets").load_ctis_cache(sid))
     print(f"CTIS cache loaded: {len(ctis_cache)} entries")
-    ctis_events, new_cache = enrich_ctis_trials(ctis_events, ctis_cache)
-    save_ctis_cache(spreadsheet_id, new_cache)
 
-    fda_events = fetch_fda_under_review()
+    checkpoint = None
+    if ctx["sink"]:
+        sheets = _import("sinks.sheets")
+        checkpoint = lambda batch: sheets.save_ctis_cache(ctx["spreadsheet_id"], batch)
+
+    ctis_events, new_cache = ctis.enrich_ctis_trials(
+        ctis_events, ctis_cache,
+        checkpoint=checkpoint,
+        checkpoint_every=ctx["checkpoint_every"], checkpoint_interval=ctx["checkpoint_interval"],
+    )
+    # Keeps a warm cache current; enrich_ema_companies updates its map in place already
+    ctis_cache.update(new_cache)
+    return ctis_events
+
+
+def run_fda(ctx):
+    fda = _import("sources.fda")
+    fda_events = fda.fetch_fda_under_review()
+    if ctx["fda_labels"]:
+        # Off unless chosen: the api backend makes one openFDA request per approval
+        enrich = _import("sources.fda_enrich_indication")
+        fda_events = enrich.enrich_fda_indications(fda_events, backend=ctx["fda_labels"])
+    return fda_events
+
+
+def run_ema_approvals(ctx):
+    ema_approvals = _import("sources.ema_approvals")
+    return ema_approvals.fetch_ema_approvals()
+
+
+STAGES = {
+    "ctgov": run_ctgov,
+    "ema_under_eval": run_ema_under_eval,
+    "ctis": run_ctis,
+    "fda": run_fda,
+    "ema_approvals": run_ema_approvals,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fetch pipeline signals and write them to Google Sheets.")
+    parser.add_argument(
+        "--sources", default=",".join(SOURCES),
+        help=f"comma-separated stages to run (default: all of {','.join(SOURCES)})",
+    )
+    parser.add_argument(
+        "--no-sink", action="store_true",
+        help="don't touch Google Sheets: skip the enrichment caches and don't write events",
+    )
+    parser.add_argument(
+        "--partition-by", choices=["source", "signal_type"], default=os.environ.get("PARTITION_BY") or None,
+        help="write each source or signal_type to its own worksheet, concurrently (env PARTITION_BY)",
+    )
+    parser.add_argument(
+        "--fda-labels", choices=["api", "local"], default=os.environ.get("FDA_LABEL_BACKEND") or None,
+        help="fill in FDA indications from openFDA labels, per approval (api) or from the bulk export "
+             "index (local) (env FDA_LABEL_BACKEND; default: off)",
+    )
+    parser.add_argument(
+        "--profile", nargs="?", const="profile", metavar="DIR",
+        help="profile each stage (CPU, memory, sampled stacks) and write reports to DIR (default: profile)",
+    )
+    parser.add_argument(
+        "--deadlines", default=os.environ.get("STAGE_DEADLINES", ""),
+        help="per-stage time budgets as source=duration pairs, e.g. ctis=20m,fda=300; 0 disables "
+             "(env STAGE_DEADLINES)",
+    )
+    parser.add_argument(
+        "--daemon", action="store_true",
+        help="keep running and refresh each source on its own cadence (see --schedule)",
+    )
+    parser.add_argument(
+        "--schedule", default=os.environ.get("SCHEDULE", ""),
+        help="daemon cadences as source=interval pairs, e.g. ctgov=6h,ctis=12h,ema_under_eval=30d (env SCHEDULE)",
+    )
+    parser.add_argument(
+        "--port", type=int, default=int(os.environ.get("DAEMON_PORT", "8787")),
+        help="daemon health/metrics port on 127.0.0.1, 0 to disable (env DAEMON_PORT, default 8787)",
+    )
+    parser.add_argument("--record", metavar="PATH", help="record every source HTTP exchange into a zip archive")
+    parser.add_argument(
+        "--replay", metavar="PATH",
+        help="serve source HTTP requests from a recorded archive without network access (implies --no-sink)",
+    )
+    parser.add_argument(
+        "--replay-latency", action="store_true",
+        help="with --replay, sleep for each exchange's recorded latency",
+    )
+    args = parser.parse_args(argv)
+    args.sources = [s.strip() for s in args.sources.split(",") if s.strip()]
+    unknown = [s for s in args.sources if s not in STAGES]
+    if unknown:
+        parser.error(f"unknown source(s): {', '.join(unknown)}")
+    if args.partition_by not in (None, "source", "signal_type"):
+        parser.error(f"invalid PARTITION_BY: {args.partition_by}")
+    if args.fda_labels not in (None, "api", "local"):
+        parser.error(f"invalid FDA_LABEL_BACKEND: {args.fda_labels}")
+    if args.record and args.replay:
+        parser.error("--record and --replay are mutually exclusive")
+    if args.replay:
+        args.no_sink = True
+    try:
+        args.deadlines = parse_durations(args.deadlines, DEFAULT_DEADLINES)
+    except ValueError as ex:
+        parser.error(str(ex))
+    if args.daemon:
+        try:
+            args.schedule = parse_durations(args.schedule, _import("daemon").DEFAULT_CADENCES)
+        except ValueError as ex:
+            parser.error(str(ex))
+        if not all(args.schedule.values()):
+            parser.error("daemon cadences must be greater than zero")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    ctx = {
+        "sink": not args.no_sink,
+        "spreadsheet_id": os.environ["SPREADSHEET_ID"] if not args.no_sink else os.environ.get("SPREADSHEET_ID", ""),
+        "worksheet": os.environ.get("WORKSHEET_NAME", "events"),
+        "partition_by": args.partition_by,
+        "fda_labels": args.fda_labels,
+        "days_back": int(os.environ.get("DAYS_BACK", "90")),
+        "checkpoint_every": int(os.environ.get("CHECKPOINT_EVERY", "25")),
+        "checkpoint_interval": float(os.environ.get("CHECKPOINT_SECONDS", "120")),
+        "deadlines": args.deadlines,
+        "overruns": [],
+    }
+
+    if args.record:
+        _import("sources.http_client").start_recording(args.record)
+    elif args.replay:
+        _import("sources.http_client").start_replay(args.replay, simulate_latency=args.replay_latency)
+
+    try:
+        if args.daemon:
+            _import("daemon").Daemon(args, ctx, sys.modules[__name__]).serve_forever()
+        else:
+            run(args, ctx)
+    finally:
+        _import("sources.http_client").stop()
+
+
+def _stage(args, name):
+    if args.profile:
+        return _import("profiler").profile_stage(name, args.profile)
+    return contextlib.nullcontext()
+
+
+def _stale_fallback(ctx, name):
+    """The stage's last good output: from this process (daemon) or from the sink."""
+    previous = ctx.get("results", {}).get(name)
+    if previous is None and ctx["sink"]:
+        sheets = _import("sinks.sheets")
+        previous = [
+            e for e in sheets.load_events(ctx["spreadsheet_id"], ctx["worksheet"], ctx["partition_by"])
+            if stage_of(e) == name
+        ]
+    return [dict(e, stale="yes") for e in previous or []]
+
+
+def _run_with_deadline(args, ctx, name, deadline):
+    http_client = _import("sources.http_client")
+    cancel = threading.Event()
+    outcome = {}
+
+    def target():
+        with http_client.cancel_scope(cancel):
+            try:
+                with _stage(args, name):
+                    outcome["events"] = STAGES[name](ctx)
+            except BaseException as ex:
+                outcome["error"] = ex
+
+    t0 = time.monotonic()
+    started_at = datetime.now(timezone.utc).isoformat()
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(target,), name=f"stage-{name}", daemon=True)
+    thread.start()
+    thread.join(deadline)
+
+    if not thread.is_alive():
+        if "error" in outcome:
+            raise outcome["error"]
+        return outcome["events"]
+
+    cancel.set()
+    thread.join(CANCEL_GRACE)
+    events = _stale_fallback(ctx, name)
+    elapsed = time.monotonic() - t0
+    ctx["overruns"].append({
+        "stage": name,
+        "deadline_seconds": deadline,
+        "elapsed_seconds": round(elapsed, 1),
+        "started_at": started_at,
+        "abandoned": thread.is_alive(),
+        "stale_rows": len(events),
+    })
+    print(f"Warning: stage {name} exceeded its {deadline:g}s deadline and was cancelled after {elapsed:.0f}s; "
+          f"reusing {len(events)} previous rows marked stale")
+    return events
+
+
+def run_stage(args, ctx, name):
+    deadline = ctx["deadlines"].get(name)
+    if deadline:
+        events = _run_with_deadline(args, ctx, name, deadline)
+    else:
+        with _stage(args, name):
+            events = STAGES[name](ctx)
+    _import("sources.http_client").log_limits()
+    return events
+
+
+def write_events(args, ctx, results):
+    """Writes {stage: events} to the sink; stages missing from `results` keep their current rows."""
+    if not ctx["sink"]:
+        all_events = [e for name in EVENT_ORDER for e in results.get(name, [])]
+        print(f"Sink disabled, {len(all_events)} events not written")
+        return
+
+    with _stage(args, "sink"):
+        sheets = _import("sinks.sheets")
+        results = dict(results)
+        if len(results) < len(STAGES):
+            # Partial run: keep the rows of the stages we didn't refresh
+            refreshed = set(results)
+            for e in sheets.load_events(ctx["spreadsheet_id"], ctx["worksheet"], ctx["partition_by"]):
+                if stage_of(e) not in refreshed:
+                    results.setdefault(stage_of(e), []).append(e)
+
+        all_events = [e for name in EVENT_ORDER for e in results.get(name, [])]
+        inserted = sheets.upsert_events(
+            ctx["spreadsheet_id"], ctx["worksheet"], all_events, partition_by=ctx["partition_by"]
+        )
+        print("Inserted rows:", inserted)
+
+        if ctx["overruns"]:
+            sheets.record_overruns(ctx["spreadsheet_id"], ctx["overruns"])
+            ctx["overruns"].clear()
+
+
+def run(args, ctx):
+    print("Running tracker...")
+    print("Sources:", ", ".join(args.sources))
+    print("Days back (CTGOV):", ctx["days_back"])
+    print(f"Startup: {time.perf_counter() - _STARTED:.2f}s")
 
-    ema_approval_events = fetch_ema_approvals()
+    results = ctx["results"] = {}
+    for name in SOURCES:
+        if name in args.sources:
+            results[name] = run_stage(args, ctx, name)
 
-    all_events = ema_events + ema_approval_events + fda_events + ctis_events + ctgov_events
+    write_events(args, ctx, results)
 
-    inserted = upsert_events(spreadsheet_id, worksheet, all_events)
-    print("Inserted rows:", inserted)
+    print(f"Imports: {_import_seconds:.2f}s; total: {time.perf_counter() - _STARTED:.2f}s")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()